@@ -0,0 +1,37 @@
+# http_session.py
+import ssl
+from typing import Optional
+
+import aiohttp
+
+# =============================
+# Shared HTTP session
+# =============================
+# 所有 OpenAI / Azure Translator 呼叫共用同一個 ClientSession，
+# 讓 TCP + TLS 連線可以 keep-alive 重複使用（不用每個 utterance 重新握手）
+_session: Optional[aiohttp.ClientSession] = None
+
+# CA 憑證只在 import 時載入一次，session 重建時也沿用同一個 context
+_SSL_CTX = ssl.create_default_context()
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Lazily create the process-wide ClientSession (must run inside the event loop)."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=_SSL_CTX,
+                limit=100,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
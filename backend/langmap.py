@@ -0,0 +1,27 @@
+# langmap.py
+from types import MappingProxyType
+
+# =============================
+# Language map (Whisper -> Azure)
+# =============================
+# 三個 WebSocket 模式共用同一份（唯讀），避免各自的 copy 改到不一致
+LANG_MAP = MappingProxyType({
+    "english": "en-US", "en": "en-US",
+    "chinese": "zh-TW", "mandarin": "zh-CN", "zh": "zh-CN",
+    "japanese": "ja-JP", "ja": "ja-JP",
+    "korean": "ko-KR", "ko": "ko-KR",
+    "thai": "th-TH", "th": "th-TH",
+    "vietnamese": "vi-VN", "vi": "vi-VN",
+    "indonesian": "id-ID", "id": "id-ID",
+    "malay": "ms-MY", "ms": "ms-MY",
+    "hindi": "hi-IN", "hi": "hi-IN",
+    "french": "fr-FR", "fr": "fr-FR",
+    "german": "de-DE", "de": "de-DE",
+    "spanish": "es-ES", "es": "es-ES",
+    "portuguese": "pt-PT", "pt": "pt-PT",
+})
+
+# Whisper 回的 language 是名字（"english"），但 request 的 language= 要 ISO-639-1（"en"）
+WHISPER_CODES = MappingProxyType({
+    name: locale.split("-")[0] for name, locale in LANG_MAP.items()
+})
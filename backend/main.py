@@ -1,18 +1,23 @@
 import os
-import io
 import time
 import asyncio
-import struct
 import logging
-from typing import List, Dict, Any, Optional
+from urllib.parse import parse_qs
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Set, Tuple
 
-import aiohttp
+import numpy as np
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import azure.cognitiveservices.speech as speechsdk
+from http_session import get_session, close_session
+from langmap import LANG_MAP
+from whisper_form import PCMLike, build_whisper_multipart, wav_header
 from ws_fixed import ws_fixed
-from ws_multilang_adaptive import ws_multilang_adaptive
+from ws_multilang_adaptive import (
+  ws_multilang_adaptive, update_candidates, get_lang_hint, load_lang_hints, save_lang_hints,
+)
 
 
 # =============================
@@ -43,141 +48,130 @@ app.add_middleware(
   allow_headers=["*"],
 )
 
+
+@app.on_event("startup")
+async def open_http_session():
+  # 共用一個 ClientSession（keep-alive / connection pool），不要每個 request 重開
+  # 先在 loop 裡建好；helper 一律用 get_session() 拿（session 重建後也不會拿到舊的）
+  get_session()
+
+
+@app.on_event("shutdown")
+async def close_http_session():
+  await close_session()
+
 # 目標翻譯語言（Azure Translator 的 to）
 TARGET_LANG = "en"
 
-# =============================
-# Language map (Whisper -> Azure)
-# =============================
-LANG_MAP = {
-  "english": "en-US", "en": "en-US",
-  "chinese": "zh-TW", "mandarin": "zh-CN", "zh": "zh-CN",
-  "japanese": "ja-JP", "ja": "ja-JP",
-  "korean": "ko-KR", "ko": "ko-KR",
-  "thai": "th-TH", "th": "th-TH",
-  "vietnamese": "vi-VN", "vi": "vi-VN",
-  "indonesian": "id-ID", "id": "id-ID",
-  "malay": "ms-MY", "ms": "ms-MY",
-  "hindi": "hi-IN", "hi": "hi-IN",
-  "french": "fr-FR", "fr": "fr-FR",
-  "german": "de-DE", "de": "de-DE",
-  "spanish": "es-ES", "es": "es-ES",
-  "portuguese": "pt-PT", "pt": "pt-PT",
-}
-
 # =============================
 # Detection timing
 # =============================
 SILENCE_RMS_THRESHOLD = 300
 MIN_DETECT_SEC = 0.8   # 等 0.8 秒就先用 Whisper 判語言
 MAX_DETECT_SEC = 8.0
+PCM_BYTES_PER_SEC = 32000  # 16 kHz * 2 bytes
+DETECT_BUFFER_BYTES = int(MAX_DETECT_SEC * PCM_BYTES_PER_SEC)
+USE_CACHED_LANG_HINT = True  # 有最近判過的語言就跳過第一次 Whisper detect
+
+# 語言還沒 lock 前，除了目前的語言之外先 warm 幾個候選語言的 recognizer
+WARM_CANDIDATES = 2
+
+# mismatch 回溯時，同時打 Whisper 的 request 上限
+REPLAY_CONCURRENCY = 8
 
 # =============================
 # Utils
 # =============================
-def pcm_to_wav(pcm: bytes) -> bytes:
-  """16 kHz mono PCM16 -> WAV bytes"""
-  buf = io.BytesIO()
-  buf.write(b"RIFF")
-  buf.write(struct.pack("<I", 36 + len(pcm)))
-  buf.write(b"WAVEfmt ")
-  buf.write(struct.pack("<IHHIIHH", 16, 1, 1, 16000, 32000, 2, 16))
-  buf.write(b"data")
-  buf.write(struct.pack("<I", len(pcm)))
-  buf.write(pcm)
-  return buf.getvalue()
-
-
 def rms_energy(pcm: bytes) -> float:
-  if not pcm:
+  a = np.frombuffer(pcm, dtype="<i2")
+  if not a.size:
     return 0.0
-  samples = struct.unpack("<" + "h" * (len(pcm) // 2), pcm)
-  return (sum(s * s for s in samples) / len(samples)) ** 0.5
+  # 一次 C-level 平方和（int64 累加，不另外配置 upcast 的暫存陣列）
+  sq = np.einsum("i,i->", a, a, dtype=np.int64)
+  return float(np.sqrt(sq / a.size))
 
 
 # =============================
 # Whisper detect (language only)
 # =============================
-async def whisper_detect(pcm: bytes) -> str:
+async def whisper_detect(pcm: PCMLike) -> str:
   """用 Whisper 根據音檔判斷語言（不取文字）"""
   if not pcm:
     return "unknown"
 
-  wav = pcm_to_wav(pcm)
   url = "https://api.openai.com/v1/audio/transcriptions"
-  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-
-  form = aiohttp.FormData()
-  form.add_field("file", wav, filename="audio.wav", content_type="audio/wav")
-  form.add_field("model", "whisper-1")
-  form.add_field("response_format", "verbose_json")
+  body, content_type = build_whisper_multipart(
+    (wav_header(len(pcm)), pcm), extra={"response_format": "verbose_json"}
+  )
+  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": content_type}
 
-  async with aiohttp.ClientSession() as session:
-    async with session.post(url, headers=headers, data=form) as resp:
-      if resp.status != 200:
-        log.error(await resp.text())
-        return "unknown"
-      data = await resp.json()
-      return (data.get("language") or "unknown").lower()
+  session = get_session()
+  async with session.post(url, headers=headers, data=body) as resp:
+    if resp.status != 200:
+      log.error(await resp.text())
+      return "unknown"
+    data = await resp.json()
+    return (data.get("language") or "unknown").lower()
 
 
 # =============================
 # Whisper transcribe (原文)
 # =============================
-async def whisper_transcribe(pcm: bytes) -> str:
+async def whisper_transcribe(pcm: PCMLike) -> str:
   """用 Whisper 拿「正確原文」（不翻譯）"""
   if not pcm:
     return ""
-  wav = pcm_to_wav(pcm)
   url = "https://api.openai.com/v1/audio/transcriptions"
-  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-
-  form = aiohttp.FormData()
-  form.add_field("file", wav, filename="audio.wav", content_type="audio/wav")
-  form.add_field("model", "whisper-1")
+  body, content_type = build_whisper_multipart((wav_header(len(pcm)), pcm))
+  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": content_type}
 
-  async with aiohttp.ClientSession() as session:
-    async with session.post(url, headers=headers, data=form) as resp:
-      if resp.status != 200:
-        log.error(await resp.text())
-        return ""
-      data = await resp.json()
-      return data.get("text", "")
+  session = get_session()
+  async with session.post(url, headers=headers, data=body) as resp:
+    if resp.status != 200:
+      log.error(await resp.text())
+      return ""
+    data = await resp.json()
+    return data.get("text", "")
 
 
 # =============================
 # Whisper translate (for correction)
 # =============================
-async def whisper_translate(pcm: bytes) -> str:
+async def whisper_translate(pcm: PCMLike) -> str:
   """
   用 Whisper 直接把這個 utterance 翻成 TARGET_LANG
   （專門用在「語言判錯後」的補救）
   """
   if not pcm:
     return ""
-  wav = pcm_to_wav(pcm)
   url = "https://api.openai.com/v1/audio/translations"
-  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+  body, content_type = build_whisper_multipart((wav_header(len(pcm)), pcm))
+  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": content_type}
 
-  form = aiohttp.FormData()
-  form.add_field("file", wav, filename="audio.wav", content_type="audio/wav")
-  form.add_field("model", "whisper-1")
-
-  async with aiohttp.ClientSession() as session:
-    async with session.post(url, headers=headers, data=form) as resp:
-      if resp.status != 200:
-        log.error(await resp.text())
-        return ""
-      data = await resp.json()
-      return data.get("text", "")
+  session = get_session()
+  async with session.post(url, headers=headers, data=body) as resp:
+    if resp.status != 200:
+      log.error(await resp.text())
+      return ""
+    data = await resp.json()
+    return data.get("text", "")
 
 
 # =============================
 # Azure Translator
 # =============================
+TRANS_CACHE_SIZE = 512
+_trans_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+
 async def azure_translate(text: str, target: str) -> str:
   if not text.strip():
     return ""
+  # partial 很常重複同一句 → 先查 LRU，命中就不用打 Translator
+  key = (target, text)
+  if key in _trans_cache:
+    _trans_cache.move_to_end(key)
+    return _trans_cache[key]
   url = "https://api.cognitive.microsofttranslator.com/translate"
   params = {"api-version": "3.0", "to": target}
   headers = {
@@ -185,40 +179,76 @@ async def azure_translate(text: str, target: str) -> str:
     "Ocp-Apim-Subscription-Region": AZURE_TRANSLATOR_REGION,
     "Content-Type": "application/json",
   }
-  async with aiohttp.ClientSession() as session:
-    async with session.post(
-      url, params=params, headers=headers, json=[{"text": text}]
-    ) as resp:
-      data = await resp.json()
-      return data[0]["translations"][0]["text"]
+  session = get_session()
+  async with session.post(
+    url, params=params, headers=headers, json=[{"text": text}]
+  ) as resp:
+    data = await resp.json()
+    trans = data[0]["translations"][0]["text"]
+  _trans_cache[key] = trans
+  if len(_trans_cache) > TRANS_CACHE_SIZE:
+    _trans_cache.popitem(last=False)
+  return trans
 
 
 # =============================
 # Embedding & cosine for merge
 # =============================
+async def embed_many(texts: List[str]) -> List[Optional[np.ndarray]]:
+  """
+  一次 round-trip 拿多句 embedding（input 給 list），回傳順序與 texts 相同
+  回傳的向量已經 L2-normalize（float32），cosine 直接內積即可
+  """
+  out: List[Optional[np.ndarray]] = [None] * len(texts)
+  idx = [i for i, t in enumerate(texts) if t]
+  if not idx:
+    return out
+  url = "https://api.openai.com/v1/embeddings"
+  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+  session = get_session()
+  async with session.post(
+    url,
+    headers=headers,
+    json={"model": "text-embedding-3-small", "input": [texts[i] for i in idx]},
+  ) as resp:
+    if resp.status != 200:
+      log.error(await resp.text())
+      return out
+    data = await resp.json()
+    for d in data["data"]:
+      vec = np.asarray(d["embedding"], dtype=np.float32)
+      vec /= np.linalg.norm(vec) + 1e-8
+      out[idx[d["index"]]] = vec
+    return out
+
+
 async def embed(text: str):
+  """單句 embedding（其實就是 embed_many 只給一句）"""
   if not text:
     return None
-  url = "https://api.openai.com/v1/embeddings"
-  headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-  async with aiohttp.ClientSession() as session:
-    async with session.post(
-      url,
-      headers=headers,
-      json={"model": "text-embedding-3-small", "input": text},
-    ) as resp:
-      if resp.status != 200:
-        log.error(await resp.text())
-        return None
-      data = await resp.json()
-      return data["data"][0]["embedding"]
-
-
-def cosine(a, b) -> float:
-  dot = sum(x * y for x, y in zip(a, b))
-  na = sum(x * x for x in a) ** 0.5
-  nb = sum(x * x for x in b) ** 0.5
-  return dot / (na * nb + 1e-8)
+  return (await embed_many([text]))[0]
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+  # embed_many 回傳的向量已經 normalize 過 → 內積就是 cosine
+  return float(a @ b)
+
+
+# =============================
+# Azure recognizer teardown
+# =============================
+def stop_recognizer(
+  recognizer: Optional[speechsdk.SpeechRecognizer],
+  push_stream: Optional[speechsdk.audio.PushAudioInputStream],
+):
+  """blocking：停掉 recognizer、關掉 push stream（錯誤忽略）"""
+  try:
+    if recognizer:
+      recognizer.stop_continuous_recognition_async().get()
+    if push_stream:
+      push_stream.close()
+  except Exception:
+    pass
 
 
 # =============================
@@ -229,9 +259,18 @@ async def ws_asr(ws: WebSocket):
   await ws.accept()
   log.info("🔌 client connected")
 
+  # --- 這個 client 上次判到的語言（同 /ws/multilang 的 client_id 機制）---
+  # 候選語言只屬於這條連線：別的使用者講什麼語言不會變成這裡的 hint
+  client_id = parse_qs(ws.url.query).get("client_id", [""])[0]
+  candidates: List[str] = []
+  if client_id:
+    candidates = await asyncio.to_thread(load_lang_hints, client_id)
+
   # --- audio buffers ---
-  detect_buffer = bytearray()         # 語言偵測用（前 0.8s）
-  current_utt_audio = bytearray()     # 當前 utterance 的 PCM（給 Whisper 保險用）
+  # 語言偵測用：一次預留 MAX_DETECT_SEC 的大小，用 detect_pos 往後寫（不用一直 extend 重新配置）
+  detect_buffer = bytearray(DETECT_BUFFER_BYTES)
+  detect_pos = 0
+  current_utt_chunks: List[bytes] = []  # 當前 utterance 的 PCM chunks（給 Whisper 保險用，用到才 join）
 
   # --- language state ---
   provisional_lang: Optional[str] = None  # Whisper 第一輪判到的語言（還沒保險）
@@ -241,12 +280,46 @@ async def ws_asr(ws: WebSocket):
   push_stream: Optional[speechsdk.audio.PushAudioInputStream] = None
   loop = asyncio.get_running_loop()
 
-  first_speech_time: Optional[float] = None
+  # --- outgoing frames：全部排進同一個 queue，由單一 sender task 依序送 ---
+  send_queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+  tail_partial: Optional[Dict[str, Any]] = None  # queue 尾端還沒送出的 partial
+
+  def send(payload: Dict[str, Any]):
+    """排進送出 queue（只能在 event loop thread 上呼叫，SDK thread 請用 call_soon_threadsafe）"""
+    nonlocal tail_partial
+    if payload["type"] == "partial" and tail_partial is not None:
+      # 連續的 partial 只有最新的有意義 → 直接覆蓋還沒送出的那一個
+      tail_partial["text"] = payload["text"]
+      return
+    send_queue.put_nowait(payload)
+    tail_partial = payload if payload["type"] == "partial" else None
+
+  async def sender():
+    nonlocal tail_partial
+    while True:
+      payload = await send_queue.get()
+      if payload is tail_partial:
+        tail_partial = None
+      try:
+        await ws.send_json(payload)
+      except Exception as e:
+        log.error(f"send error: {e}")
+        return
+
+  sender_task = loop.create_task(sender())
+
+  # --- 還沒送出的 mid_translate（所有 recognizer 共用，斷線時一起 cancel）---
+  mid_translate_tasks: Set[asyncio.Task] = set()
+
+  # --- warm recognizer pool (azure lang -> task of (recognizer, push_stream)) ---
+  warm_pool: Dict[str, asyncio.Task] = {}
+  active_azure_lang: Optional[str] = None
 
   # --- sentence merge state (for translation output) ---
   last_translation_text: Optional[str] = None
   last_translation_time: Optional[float] = None
   last_translation_embedding: Any = None
+  last_translation_source: Optional[str] = None  # last_translation_embedding 對應的那句翻譯（lazy embed 用）
 
   # --- utterance history (for rewind when mismatch) ---
   # 每個元素：{"pcm": bytes, "azure_text": str, "azure_translation": str}
@@ -255,12 +328,8 @@ async def ws_asr(ws: WebSocket):
   # =============================
   # Azure ASR control
   # =============================
-  async def start_azure(lang: str):
-    """啟動指定語言的 Azure ASR session"""
-    nonlocal recognizer, push_stream
-    nonlocal last_translation_text, last_translation_time, last_translation_embedding
-
-    azure_lang = LANG_MAP.get(lang, "en-US")
+  async def build_azure(azure_lang: str):
+    """建立並啟動指定語言的 Azure ASR session，回傳 (recognizer, push_stream)"""
     log.info(f"🟢 Azure ASR start: {azure_lang}")
 
     cfg = speechsdk.SpeechConfig(
@@ -269,30 +338,63 @@ async def ws_asr(ws: WebSocket):
     )
     cfg.speech_recognition_language = azure_lang
 
-    push_stream = speechsdk.audio.PushAudioInputStream(
+    stream = speechsdk.audio.PushAudioInputStream(
       speechsdk.audio.AudioStreamFormat(16000, 16, 1)
     )
-    recognizer = speechsdk.SpeechRecognizer(
-      cfg, speechsdk.audio.AudioConfig(stream=push_stream)
+    rec = speechsdk.SpeechRecognizer(
+      cfg, speechsdk.audio.AudioConfig(stream=stream)
     )
 
+    last_mid_source = ""
+
     async def send_mid_translate(text: str):
       # partial 的即時翻譯：語言還沒 lock 的時候也可以翻，但前端可以標示「provisional」
+      nonlocal last_mid_source
+      # ASR 往回修（新 partial 是上一次已翻原文的 prefix）→ 沿用前端現有的翻譯，等下一個 partial 再更新
+      if last_mid_source.startswith(text):
+        return
+      last_mid_source = text
       trans = await azure_translate(text, TARGET_LANG)
-      await ws.send_json({"type": "mid_translate", "translated": trans})
+      send({"type": "mid_translate", "translated": trans})
+
+    # --- partial 翻譯 debounce（同 ws_fixed.py）---
+    last_partial_text = ""
+    translate_task: Optional[asyncio.Task] = None
+
+    def schedule_mid_translate(text: str):
+      # 在 event loop 上跑：cancel 上一次還沒送出的翻譯，停 300ms 沒新 partial 才翻
+      nonlocal translate_task
+      if translate_task:
+        translate_task.cancel()
+
+      async def delayed_translate():
+        try:
+          await asyncio.sleep(0.3)  # debounce
+          await send_mid_translate(text)
+        except asyncio.CancelledError:
+          pass
+
+      translate_task = loop.create_task(delayed_translate())
+      mid_translate_tasks.add(translate_task)
+      translate_task.add_done_callback(mid_translate_tasks.discard)
 
     def on_partial(evt):
-      if evt.result.text:
-        # partial ASR
-        asyncio.run_coroutine_threadsafe(
-          ws.send_json({"type": "partial", "text": evt.result.text}),
-          loop,
-        )
-        # partial 翻譯
-        asyncio.run_coroutine_threadsafe(
-          send_mid_translate(evt.result.text),
-          loop,
-        )
+      nonlocal last_partial_text
+
+      text = evt.result.text
+      if not text:
+        return
+
+      # partial ASR
+      loop.call_soon_threadsafe(send, {"type": "partial", "text": text})
+
+      # 沒變就不翻
+      if text == last_partial_text:
+        return
+      last_partial_text = text
+
+      # partial 翻譯（callback 在 SDK thread → 交給 loop 排程）
+      loop.call_soon_threadsafe(schedule_mid_translate, text)
 
     async def on_final(text: str):
       """
@@ -302,25 +404,40 @@ async def ws_asr(ws: WebSocket):
       3. 若發現 mismatch → 回溯「所有已經講過的 utterances」重新翻譯
       """
       nonlocal provisional_lang, lang_locked
-      nonlocal current_utt_audio
+      nonlocal current_utt_chunks
+      nonlocal last_mid_source
       nonlocal last_translation_text, last_translation_time, last_translation_embedding
+      nonlocal last_translation_source
       nonlocal utterance_history
+      nonlocal translate_task, last_partial_text
+
+      # 上一句 partial 還沒送出的 mid_translate 不能晚於這句的 final_translate 到
+      # （也不能在下面 reset 之後又把 last_mid_source 改回舊句）
+      if translate_task:
+        translate_task.cancel()
+        translate_task = None
+
+      # 新句子的 partial 不該沿用上一句的翻譯
+      last_mid_source = ""
+      last_partial_text = ""
 
       # 這個 utterance 單獨的 PCM（保險用）
-      utt_pcm = bytes(current_utt_audio)
+      utt_pcm = b"".join(current_utt_chunks)
 
       # 先把這一句記錄到 history（先記 PCM，之後補上 text / translation）
+      # history 只給「語言 lock 之前」的回溯用 → lock 之後就不再留 PCM
       history_entry: Dict[str, Any] = {
         "pcm": utt_pcm,
         "azure_text": text,
         "azure_translation": None,
       }
-      utterance_history.append(history_entry)
+      if not lang_locked:
+        utterance_history.append(history_entry)
 
       # -----------------
       # 1) 原文
       # -----------------
-      await ws.send_json({"type": "final", "text": text})
+      send({"type": "final", "text": text})
 
       # 2) 翻譯（先照目前語言翻，是否 provisional 由 lang_locked 決定）
       trans = await azure_translate(text, TARGET_LANG)
@@ -329,25 +446,32 @@ async def ws_asr(ws: WebSocket):
       now = time.perf_counter()
       merge = False
       emb = None
-      try:
-        emb = await embed(trans)
-      except Exception as e:
-        log.error(f"embedding error: {e}")
-
+      # 停頓 >= 1s 一定不會 merge → 根本不用打 embedding
+      # 上一句的 embedding 也是 lazy：真的要比的時候才跟這句一起 batch 算
       if (
-        emb is not None
-        and last_translation_embedding is not None
-        and last_translation_time is not None
+        last_translation_time is not None
+        and last_translation_source is not None
+        and now - last_translation_time < 1.0
       ):
+        try:
+          if last_translation_embedding is None:
+            last_translation_embedding, emb = await embed_many(
+              [last_translation_source, trans]
+            )
+          else:
+            emb = await embed(trans)
+        except Exception as e:
+          log.error(f"embedding error: {e}")
+
+      if emb is not None and last_translation_embedding is not None:
         sim = cosine(emb, last_translation_embedding)
-        dt = now - last_translation_time
         # 語境接近 / 停頓短 → 視為同一句補尾巴
-        if sim > 0.75 and dt < 1.0:
+        if sim > 0.75:
           merge = True
 
       if merge and last_translation_text is not None:
         merged_text = last_translation_text + " " + trans
-        await ws.send_json(
+        send(
           {
             "type": "final_translate",
             "translated": merged_text,
@@ -357,7 +481,7 @@ async def ws_asr(ws: WebSocket):
         )
         last_translation_text = merged_text
       else:
-        await ws.send_json(
+        send(
           {
             "type": "final_translate",
             "translated": trans,
@@ -367,9 +491,9 @@ async def ws_asr(ws: WebSocket):
         )
         last_translation_text = trans
 
-      if emb is not None:
-        last_translation_embedding = emb
-        last_translation_time = now
+      last_translation_source = trans
+      last_translation_embedding = emb
+      last_translation_time = now
 
       # -----------------
       # 3) Whisper 保險：用「整句 utterance」重判語言
@@ -377,13 +501,16 @@ async def ws_asr(ws: WebSocket):
       detected = await whisper_detect(utt_pcm)
       log.info(f"🔍 Verification detect (this utt): {detected}")
 
+      if detected in LANG_MAP:
+        update_candidates(detected, candidates)
+
       # 第一次有 provisional 結果時，Whisper 也還沒判過 → 這裡補上
       if provisional_lang is None and detected in LANG_MAP:
         provisional_lang = detected
 
       # ✅ 語言已經 lock 過就不再動了（你目前設計）
       if lang_locked:
-        current_utt_audio.clear()
+        current_utt_chunks.clear()
         return
 
       # --- Case A: mismatch → 直接改用新語言，並回溯所有 utterances ---
@@ -396,20 +523,35 @@ async def ws_asr(ws: WebSocket):
         last_translation_text = None
         last_translation_embedding = None
         last_translation_time = None
+        last_translation_source = None
 
         # 1) 通知前端：所有之前的 ASR / translation 都是錯的 → 全部畫刪除線
-        await ws.send_json({"type": "invalidate_all_asr"})
-        await ws.send_json({"type": "invalidate_all_translation"})
+        send({"type": "invalidate_all_asr"})
+        send({"type": "invalidate_all_translation"})
 
         # 2) 用新語言（實際上 Whisper auto detect）對「所有歷史 utterances」重翻
-        for idx, entry in enumerate(utterance_history):
-          pcm_bytes: bytes = entry["pcm"]
-
-          correct_text = await whisper_transcribe(pcm_bytes)
-          correct_trans = await whisper_translate(pcm_bytes)
+        #    每句的 transcribe / translate 互不相依 → 全部一起打（Semaphore 限制同時 request 數）
+        replay_sem = asyncio.Semaphore(REPLAY_CONCURRENCY)
+
+        async def bounded(coro):
+          async with replay_sem:
+            return await coro
+
+        results = await asyncio.gather(
+          *(
+            asyncio.gather(
+              bounded(whisper_transcribe(entry["pcm"])),
+              bounded(whisper_translate(entry["pcm"])),
+            )
+            for entry in utterance_history
+          )
+        )
 
+        # 結果照原本順序送給前端
+        replayed_translations: List[str] = []
+        for correct_text, correct_trans in results:
           if correct_text.strip():
-            await ws.send_json(
+            send(
               {
                 "type": "final",
                 "text": correct_text,
@@ -419,7 +561,7 @@ async def ws_asr(ws: WebSocket):
             )
 
           if correct_trans.strip():
-            await ws.send_json(
+            send(
               {
                 "type": "final_translate",
                 "translated": correct_trans,
@@ -428,17 +570,14 @@ async def ws_asr(ws: WebSocket):
                 "replayed": True,
               }
             )
-            # 更新 merge context（以最後一條為基準）
-            now2 = time.perf_counter()
-            try:
-              emb2 = await embed(correct_trans)
-            except Exception as e:
-              log.error(f"embedding(corrected) error: {e}")
-              emb2 = None
-            last_translation_text = correct_trans
-            if emb2 is not None:
-              last_translation_embedding = emb2
-              last_translation_time = now2
+            replayed_translations.append(correct_trans)
+
+        # 更新 merge context（以最後一條為基準）：embedding 等下一句真的要比的時候再算
+        if replayed_translations:
+          last_translation_text = replayed_translations[-1]
+          last_translation_source = replayed_translations[-1]
+          last_translation_embedding = None
+          last_translation_time = time.perf_counter()
 
         # 3) 清掉 history（因為已經用 Whisper 正確重放）
         utterance_history.clear()
@@ -446,48 +585,78 @@ async def ws_asr(ws: WebSocket):
         # 4) 把語言 lock 在新的 detected，並重啟 Azure ASR
         provisional_lang = detected
         lang_locked = True
-        await ws.send_json({"type": "lang_locked", "lang": detected})
+        send({"type": "lang_locked", "lang": detected})
         await restart_azure()
+        discard_warm()
 
       # --- Case B: match → 第一句驗證通過，直接 lock in ---
       elif provisional_lang is not None and detected == provisional_lang:
         log.info(f"✅ Language verified and locked: {detected}")
         lang_locked = True
-        await ws.send_json({"type": "lang_locked", "lang": detected})
+        send({"type": "lang_locked", "lang": detected})
+        discard_warm()
+        # 已經驗證通過，不會再回溯 → history 的 PCM 可以丟了
+        utterance_history.clear()
 
       # （Case C: detected 不在 LANG_MAP or unknown → 先保持現狀，等下一句再說）
 
-      current_utt_audio.clear()
+      current_utt_chunks.clear()
 
-    recognizer.recognizing.connect(on_partial)
-    recognizer.recognized.connect(
+    rec.recognizing.connect(on_partial)
+    rec.recognized.connect(
       lambda e: asyncio.run_coroutine_threadsafe(
         on_final(e.result.text), loop
       )
     )
-    recognizer.start_continuous_recognition_async().get()
+    # start 在 thread pool 等，背景 warm 的時候才不會卡住 event loop
+    await loop.run_in_executor(
+      None, lambda: rec.start_continuous_recognition_async().get()
+    )
+    return rec, stream
 
-  async def restart_azure():
-    """停掉舊的 recognizer，換新的語言重啟"""
-    nonlocal recognizer, push_stream
-    log.info("♻️ Restart Azure ASR with new language")
+  def warm_azure(lang: str):
+    """背景先把候選語言的 recognizer 開好（不餵音訊），語言切換時直接換過去"""
+    azure_lang = LANG_MAP.get(lang, "en-US")
+    if azure_lang in warm_pool or azure_lang == active_azure_lang:
+      return
+    warm_pool[azure_lang] = loop.create_task(build_azure(azure_lang))
 
-    try:
-      if recognizer:
-        recognizer.stop_continuous_recognition_async().get()
-      if push_stream:
-        push_stream.close()
-    except Exception:
-      pass
+  def discard_warm():
+    """語言已 lock → 不會再切換，把 warm 的 recognizer 都收掉"""
+    def _stop(task: asyncio.Task):
+      if not task.cancelled() and task.exception() is None:
+        loop.run_in_executor(None, stop_recognizer, *task.result())
 
-    recognizer = None
-    push_stream = None
+    for task in warm_pool.values():
+      task.add_done_callback(_stop)
+    warm_pool.clear()
 
-    # 給 Azure SDK 一點時間確實停乾淨
-    await asyncio.sleep(0.2)
+  async def start_azure(lang: str):
+    """啟動指定語言的 Azure ASR session（有 warm 好的就直接拿來用）"""
+    nonlocal recognizer, push_stream, active_azure_lang
 
+    azure_lang = LANG_MAP.get(lang, "en-US")
+    task = warm_pool.pop(azure_lang, None)
+    if task is not None:
+      try:
+        recognizer, push_stream = await task
+        active_azure_lang = azure_lang
+        log.info(f"♨️ Azure ASR swap to warm recognizer: {azure_lang}")
+        return
+      except Exception as e:
+        log.error(f"warm recognizer error: {e}")
+
+    recognizer, push_stream = await build_azure(azure_lang)
+    active_azure_lang = azure_lang
+
+  async def restart_azure():
+    """換新的語言：先接上新的 recognizer，舊的丟到背景停（不擋 critical path）"""
+    log.info("♻️ Restart Azure ASR with new language")
+
+    old = (recognizer, push_stream)
     if provisional_lang:
       await start_azure(provisional_lang)
+    loop.run_in_executor(None, stop_recognizer, *old)
 
   # =============================
   # Main loop
@@ -495,25 +664,37 @@ async def ws_asr(ws: WebSocket):
   try:
     async for chunk in ws.iter_bytes():
       # chunk = 16kHz mono PCM16
-      current_utt_audio.extend(chunk)
+      current_utt_chunks.append(chunk)
 
       # --- 語言尚未決定，先做偵測（UNTIL） ---
       if provisional_lang is None:
+        # ⚡ 這個 client 上次判過的語言 → 直接當 provisional，不等 0.8s 也不打 Whisper
+        #    第一句 on_final 的 Whisper 驗證一樣會做保險（mismatch 就回溯）
+        hint = get_lang_hint(candidates) if USE_CACHED_LANG_HINT else None
+        if hint in LANG_MAP:
+          log.info(f"⚡ Provisional language from cache: {hint}")
+          provisional_lang = hint
+
         # 太小聲就先丟掉
-        if rms_energy(chunk) < SILENCE_RMS_THRESHOLD:
+        elif rms_energy(chunk) < SILENCE_RMS_THRESHOLD:
           continue
 
-        if first_speech_time is None:
-          first_speech_time = time.perf_counter()
-
-        detect_buffer.extend(chunk)
-        elapsed = time.perf_counter() - first_speech_time
+        # 超過預留大小的話 slice assignment 會自己長大
+        end = detect_pos + len(chunk)
+        detect_buffer[detect_pos:end] = chunk
+        detect_pos = end
+        # 用收到的語音 bytes 算秒數（不用每個 chunk 讀 clock，也不受網路 jitter 影響）
+        elapsed = detect_pos / PCM_BYTES_PER_SEC
 
         # 至少聽滿 MIN_DETECT_SEC 再丟去 Whisper
         if elapsed >= MIN_DETECT_SEC and provisional_lang is None:
-          lang = await whisper_detect(bytes(detect_buffer))
+          with memoryview(detect_buffer)[:detect_pos] as view:
+            lang = await whisper_detect(view)
           log.info(f"🕒 Initial detect language: {lang}")
-          if lang not in LANG_MAP:
+          if lang in LANG_MAP:
+            # 只有 Whisper 真的判到的語言才進候選（硬用的 english / cache hint 不算）
+            update_candidates(lang, candidates)
+          else:
             lang = "english"
           provisional_lang = lang
 
@@ -523,11 +704,18 @@ async def ws_asr(ws: WebSocket):
 
         # 一旦決定 provisional_lang：啟動 Azure ASR，開始即時翻譯
         if provisional_lang:
-          await ws.send_json({"type": "lang", "lang": provisional_lang})
+          send({"type": "lang", "lang": provisional_lang})
           await start_azure(provisional_lang)
-          if push_stream and detect_buffer:
-            push_stream.write(bytes(detect_buffer))
+          if push_stream and detect_pos:
+            push_stream.write(bytes(memoryview(detect_buffer)[:detect_pos]))
+          # 之後用不到了，直接把預留的 buffer 放掉
           detect_buffer.clear()
+          detect_pos = 0
+
+          # 這個 client 最近看過的其他語言先 warm 起來，第一句驗證 mismatch 時可以直接切換
+          for cand in candidates[:WARM_CANDIDATES + 1]:
+            if cand != provisional_lang and cand in LANG_MAP:
+              warm_azure(cand)
         continue
 
       # --- 語言已經有 provisional，直接塞到 Azure push_stream ---
@@ -536,13 +724,13 @@ async def ws_asr(ws: WebSocket):
 
   finally:
     log.info("🔌 client disconnected")
-    try:
-      if recognizer:
-        recognizer.stop_continuous_recognition_async().get()
-      if push_stream:
-        push_stream.close()
-    except Exception:
-      pass
+    sender_task.cancel()
+    for task in list(mid_translate_tasks):
+      task.cancel()
+    discard_warm()
+    await loop.run_in_executor(None, stop_recognizer, recognizer, push_stream)
+    if client_id:
+      await asyncio.to_thread(save_lang_hints, client_id, list(candidates))
 
 
 @app.websocket("/ws/fixed")
@@ -0,0 +1,73 @@
+# whisper_form.py
+import struct
+import uuid
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+import numpy as np
+
+PCMLike = Union[bytes, bytearray, memoryview]
+
+# =============================
+# WAV header (16-bit / mono, 預設 16 kHz)
+# =============================
+# 44 bytes 裡只有兩個長度欄位（跟 sample rate / byte rate）會變
+_WAV_HEADER = bytes(
+    b"RIFF\x00\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00"
+    b"\x80\x3e\x00\x00\x00\x7d\x00\x00\x02\x00\x10\x00data\x00\x00\x00\x00"
+)
+
+
+def wav_header(pcm_len: int, sample_rate: int = 16000) -> bytes:
+    hdr = bytearray(_WAV_HEADER)
+    struct.pack_into("<I", hdr, 4, 36 + pcm_len)
+    if sample_rate != 16000:
+        struct.pack_into("<II", hdr, 24, sample_rate, sample_rate * 2)
+    struct.pack_into("<I", hdr, 40, pcm_len)
+    return bytes(hdr)
+
+
+def downsample_to_8k(pcm: PCMLike) -> bytes:
+    """16 kHz int16 → 8 kHz：相鄰兩個 sample 取平均（順便當簡單的 low-pass）"""
+    a = np.frombuffer(pcm, dtype="<i2")
+    n = a.size & ~1
+    pairs = a[:n].reshape(-1, 2).astype(np.int32)
+    return (pairs.sum(axis=1) >> 1).astype("<i2").tobytes()
+
+
+# =============================
+# Whisper multipart body
+# =============================
+# Whisper upload 的欄位固定 → boundary 跟 part header 在 import 時組好一次，
+# 每個 request 只要把音檔 join 進去（不用 aiohttp.FormData 每次重新 encode）
+_BOUNDARY = f"----asrboundary{uuid.uuid4().hex}".encode()
+_CONTENT_TYPE = "multipart/form-data; boundary=" + _BOUNDARY.decode()
+_FILE_HEAD = (
+    b"--" + _BOUNDARY + b"\r\n"
+    b'Content-Disposition: form-data; name="file"; filename="audio.wav"\r\n'
+    b"Content-Type: audio/wav\r\n\r\n"
+)
+_CLOSE = b"--" + _BOUNDARY + b"--\r\n"
+
+
+def _field(name: str, value: str) -> bytes:
+    return (
+        b"--" + _BOUNDARY + b"\r\n"
+        b'Content-Disposition: form-data; name="' + name.encode() + b'"\r\n\r\n'
+        + value.encode() + b"\r\n"
+    )
+
+
+def build_whisper_multipart(
+    wav_parts: Iterable[PCMLike],
+    model: str = "whisper-1",
+    extra: Optional[Dict[str, str]] = None,
+) -> Tuple[bytes, str]:
+    """
+    把 WAV（header + PCM 分開傳，只 copy 一次）包成 multipart body
+    回傳 (body, content_type)，直接給 session.post(data=body, headers={"Content-Type": ...})
+    """
+    parts = [_FILE_HEAD, *wav_parts, b"\r\n", _field("model", model)]
+    for name, value in (extra or {}).items():
+        parts.append(_field(name, value))
+    parts.append(_CLOSE)
+    return b"".join(parts), _CONTENT_TYPE
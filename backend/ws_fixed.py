@@ -2,13 +2,17 @@
 import os
 import asyncio
 import logging
+from collections import OrderedDict
+from typing import Tuple
 from urllib.parse import parse_qs
 
 from fastapi import WebSocket
 import azure.cognitiveservices.speech as speechsdk
-import aiohttp
 from dotenv import load_dotenv
 
+from http_session import get_session
+from langmap import LANG_MAP
+
 load_dotenv()
 
 # =============================
@@ -17,25 +21,6 @@ load_dotenv()
 log = logging.getLogger("asr.fixed")
 log.setLevel(logging.INFO)
 
-# =============================
-# Language map (fixed mode)
-# =============================
-LANG_MAP = {
-    "english": "en-US", "en": "en-US",
-    "chinese": "zh-TW", "mandarin": "zh-CN", "zh": "zh-CN",
-    "japanese": "ja-JP", "ja": "ja-JP",
-    "korean": "ko-KR", "ko": "ko-KR",
-    "thai": "th-TH", "th": "th-TH",
-    "vietnamese": "vi-VN", "vi": "vi-VN",
-    "indonesian": "id-ID", "id": "id-ID",
-    "malay": "ms-MY", "ms": "ms-MY",
-    "hindi": "hi-IN", "hi": "hi-IN",
-    "french": "fr-FR", "fr": "fr-FR",
-    "german": "de-DE", "de": "de-DE",
-    "spanish": "es-ES", "es": "es-ES",
-    "portuguese": "pt-PT", "pt": "pt-PT",
-}
-
 # =============================
 # Translation config
 # =============================
@@ -46,10 +31,20 @@ AZURE_TRANSLATOR_REGION = os.getenv("AZURE_TRANSLATOR_REGION")
 # =============================
 # Azure Translator
 # =============================
+TRANS_CACHE_SIZE = 512
+_trans_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+
 async def azure_translate(text: str, target: str) -> str:
     if not text or not text.strip():
         return ""
 
+    # 同一句 partial / final 重複出現 → 直接用 LRU 裡的翻譯
+    key = (target, text)
+    if key in _trans_cache:
+        _trans_cache.move_to_end(key)
+        return _trans_cache[key]
+
     url = "https://api.cognitive.microsofttranslator.com/translate"
     params = {
         "api-version": "3.0",
@@ -62,24 +57,29 @@ async def azure_translate(text: str, target: str) -> str:
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url,
-                params=params,
-                headers=headers,
-                json=[{"text": text}],
-            ) as resp:
-                if resp.status != 200:
-                    err = await resp.text()
-                    log.error(f"❌ Azure translate HTTP {resp.status}: {err}")
-                    return ""
-
-                data = await resp.json()
-                return data[0]["translations"][0]["text"]
+        session = get_session()
+        async with session.post(
+            url,
+            params=params,
+            headers=headers,
+            json=[{"text": text}],
+        ) as resp:
+            if resp.status != 200:
+                err = await resp.text()
+                log.error(f"❌ Azure translate HTTP {resp.status}: {err}")
+                return ""
+
+            data = await resp.json()
+            trans = data[0]["translations"][0]["text"]
     except Exception as e:
         log.error(f"❌ translate exception: {e}")
         return ""
 
+    _trans_cache[key] = trans
+    if len(_trans_cache) > TRANS_CACHE_SIZE:
+        _trans_cache.popitem(last=False)
+    return trans
+
 # =============================
 # WebSocket: Fixed Language Mode
 # =============================
@@ -226,7 +226,10 @@ async def ws_fixed(ws: WebSocket):
     recognizer.recognizing.connect(on_recognizing)
     recognizer.recognized.connect(on_recognized)
 
-    recognizer.start_continuous_recognition_async().get()
+    # SDK 的 .get() 會 block → 丟到 thread pool 等，不要卡住其他連線的 event loop
+    await loop.run_in_executor(
+        None, lambda: recognizer.start_continuous_recognition_async().get()
+    )
     log.info("🟢 Azure ASR started (fixed + instant translate)")
 
     # -------- audio loop --------
@@ -237,7 +240,9 @@ async def ws_fixed(ws: WebSocket):
     finally:
         log.info("🔌 Fixed client disconnected")
         try:
-            recognizer.stop_continuous_recognition_async().get()
+            await loop.run_in_executor(
+                None, lambda: recognizer.stop_continuous_recognition_async().get()
+            )
             push_stream.close()
         except Exception:
             pass
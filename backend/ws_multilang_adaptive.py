@@ -1,17 +1,24 @@
 # ws_multilang_adaptive.py
 import os
-import io
-import struct
-import time
+import re
+import json
+import queue
 import asyncio
+import tempfile
 import logging
-from typing import List, Optional
+from urllib.parse import parse_qs
+from typing import List, Optional, Set
 
+import numpy as np
+import orjson
 from fastapi import WebSocket
 from dotenv import load_dotenv
-import aiohttp
 import azure.cognitiveservices.speech as speechsdk
 
+from http_session import get_session
+from langmap import LANG_MAP, WHISPER_CODES
+from whisper_form import PCMLike, build_whisper_multipart, downsample_to_8k, wav_header
+
 # =============================
 # Init
 # =============================
@@ -34,92 +41,202 @@ TARGET_LANG = "en"
 # =============================
 # Language candidate cache
 # =============================
-LANG_CANDIDATES: List[str] = []
+# 候選語言一律是「每條連線自己一份」（[0] 是最新的）；不同使用者不能互相影響 hint
 MAX_CANDIDATES = 5
 
 
-def update_candidates(lang: str):
+def update_candidates(lang: str, candidates: List[str]):
     if not lang or lang == "unknown":
         return
-    if lang in LANG_CANDIDATES:
-        LANG_CANDIDATES.remove(lang)
-    LANG_CANDIDATES.insert(0, lang)
-    if len(LANG_CANDIDATES) > MAX_CANDIDATES:
-        LANG_CANDIDATES.pop()
-    log.info(f"🌐 Language candidates: {LANG_CANDIDATES}")
+    if lang in candidates:
+        candidates.remove(lang)
+    candidates.insert(0, lang)
+    if len(candidates) > MAX_CANDIDATES:
+        candidates.pop()
+    log.info(f"🌐 Language candidates: {candidates}")
 
 
-def get_lang_hint() -> Optional[str]:
-    return LANG_CANDIDATES[0] if LANG_CANDIDATES else None
+def get_lang_hint(candidates: List[str]) -> Optional[str]:
+    return candidates[0] if candidates else None
+
+
+# =============================
+# Language hint persistence (per client)
+# =============================
+# 每個 client 的候選語言存成小 JSON 檔，重新連線時先載回來 → 第一句就有 hint
+LANG_HINT_DIR = os.getenv(
+    "LANG_HINT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "instant_translation", "lang_hints"),
+)
+LANG_HINT_SAVE_SEC = 5.0
+# client_id 是前端自己產生的 → 檔案數要有上限，超過就刪最久沒更新的
+LANG_HINT_MAX_FILES = 1000
+
+
+def _lang_hint_path(client_id: str) -> Optional[str]:
+    safe = re.sub(r"[^A-Za-z0-9_-]", "", client_id)[:64]
+    if not safe:
+        return None
+    return os.path.join(LANG_HINT_DIR, f"{safe}.json")
+
+
+def load_lang_hints(client_id: str) -> List[str]:
+    """讀回這個 client 的候選語言（[0] 是最新的）；檔案不在 / 格式不對就回空 list"""
+    path = _lang_hint_path(client_id)
+    if not path:
+        return []
+    try:
+        with open(path, encoding="utf-8") as f:
+            langs = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if not isinstance(langs, list):
+        return []
+    return [lang for lang in langs if isinstance(lang, str) and lang in WHISPER_CODES][:MAX_CANDIDATES]
+
+
+def _prune_lang_hints():
+    try:
+        with os.scandir(LANG_HINT_DIR) as it:
+            files = [e for e in it if e.name.endswith(".json") and e.is_file()]
+    except OSError:
+        return
+    excess = len(files) - LANG_HINT_MAX_FILES + 1
+    if excess <= 0:
+        return
+    files.sort(key=lambda e: e.stat().st_mtime)
+    for e in files[:excess]:
+        try:
+            os.remove(e.path)
+        except OSError:
+            pass
+
+
+def save_lang_hints(client_id: str, langs: List[str]):
+    path = _lang_hint_path(client_id)
+    if not path:
+        return
+    try:
+        os.makedirs(LANG_HINT_DIR, exist_ok=True)
+        if not os.path.exists(path):
+            # 新的 client 才會多一個檔 → 這時候才需要檢查上限
+            _prune_lang_hints()
+        fd, tmp = tempfile.mkstemp(dir=LANG_HINT_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(langs, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.error(f"❌ save lang hints failed: {e}")
+
+
+# =============================
+# Utterance PCM buffer pool
+# =============================
+# 每條連線自己一個 pool（不跟別的連線搶）；一塊 15s = 480 KB，超過就強制斷句
+MAX_UTT_SEC = 15
+MAX_UTT_BYTES = 16000 * 2 * MAX_UTT_SEC
+PCM_POOL_SIZE = 3
+
+
+class PCMBufferPool:
+    """
+    固定大小的 PCM slab pool：每句寫進借來的 slab，Whisper 處理完再還回來
+    steady state 下音訊 loop 不用再配置 / 釋放幾百 KB 的 bytes
+    """
+
+    def __init__(self, slab_bytes: int, size: int):
+        self.slab_bytes = slab_bytes
+        self.size = size
+        self._free: List[bytearray] = []
+
+    def acquire(self) -> bytearray:
+        # 全部借出去（Whisper 都還在跑）就臨時多配一塊，不要擋住音訊 loop
+        return self._free.pop() if self._free else bytearray(self.slab_bytes)
+
+    def release(self, slab: bytearray):
+        # 同一塊還兩次的話會被兩個人同時借走 → 已經在 free list 裡就忽略
+        if any(s is slab for s in self._free):
+            return
+        if len(self._free) < self.size:
+            self._free.append(slab)
+
+
+# client 送來的小 frame 湊到 100ms（16 kHz * 2 bytes * 0.1s）才寫一次 Azure
+PUSH_COALESCE_BYTES = 3200
+
+# Azure result 的 offset / duration 是 100ns ticks → 換成 PCM stream 裡的 byte 位置
+PCM_BYTES_PER_SEC = 32000  # 16 kHz * 2 bytes
+TICKS_PER_SEC = 10_000_000
+
+# 🛡 Azure session 被 cancel（quota / auth / 網路）→ 退回本地 RMS VAD 斷句
+SILENCE_RMS = 300
+SILENCE_SEC = 0.8
+SILENCE_BYTES = int(SILENCE_SEC * PCM_BYTES_PER_SEC)
+
+# 🔉 translate 只送 8 kHz（mel frame 減半）；transcribe 維持 16 kHz 保住 lang-ID
+#    預設關閉，設 WHISPER_TRANSLATE_8K=1 開啟來比較翻譯品質
+WHISPER_TRANSLATE_8K = os.getenv("WHISPER_TRANSLATE_8K") == "1"
+
+# 每條連線同時在打 Whisper 的句子上限；講很快時多的句子排隊，不要一次爆一堆 call
+UTT_CONCURRENCY = 3
 
 
 # =============================
 # Audio utils
 # =============================
-def pcm_to_wav(pcm: bytes) -> bytes:
-    buf = io.BytesIO()
-    buf.write(b"RIFF")
-    buf.write(struct.pack("<I", 36 + len(pcm)))
-    buf.write(b"WAVEfmt ")
-    buf.write(struct.pack("<IHHIIHH", 16, 1, 1, 16000, 32000, 2, 16))
-    buf.write(b"data")
-    buf.write(struct.pack("<I", len(pcm)))
-    buf.write(pcm)
-    return buf.getvalue()
-
-
-def rms_energy(pcm: bytes) -> float:
-    if not pcm:
+def rms_energy(pcm: PCMLike) -> float:
+    a = np.frombuffer(pcm, dtype="<i2")
+    if not a.size:
         return 0.0
-    samples = struct.unpack("<" + "h" * (len(pcm) // 2), pcm)
-    return (sum(s * s for s in samples) / len(samples)) ** 0.5
+    sq = np.einsum("i,i->", a, a, dtype=np.int64)
+    return float(np.sqrt(sq / a.size))
 
 
 # =============================
 # Whisper helpers
 # =============================
 async def whisper_transcribe_with_hint(
-    pcm: bytes,
+    pcm: PCMLike,
     lang_hint: Optional[str],
 ):
-    wav = pcm_to_wav(pcm)
     url = "https://api.openai.com/v1/audio/transcriptions"
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-
-    form = aiohttp.FormData()
-    form.add_field("file", wav, filename="audio.wav", content_type="audio/wav")
-    form.add_field("model", "whisper-1")
-    form.add_field("response_format", "verbose_json")
+    extra = {"response_format": "verbose_json"}
 
     # ✅ Fast-path: language hint (skip detect)
-    if lang_hint:
-        form.add_field("language", lang_hint)
+    #    hint 是 Whisper 回的名字 → 換成 ISO code；對不到的就不帶（免得 request 直接失敗）
+    code = WHISPER_CODES.get(lang_hint) if lang_hint else None
+    if code:
+        extra["language"] = code
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=form) as resp:
-            if resp.status != 200:
-                log.error(await resp.text())
-                return "unknown", ""
-            data = await resp.json()
-            return (data.get("language") or "unknown"), (data.get("text") or "")
+    body, content_type = build_whisper_multipart((wav_header(len(pcm)), pcm), extra=extra)
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": content_type}
 
+    session = get_session()
+    async with session.post(url, headers=headers, data=body) as resp:
+        if resp.status != 200:
+            log.error(await resp.text())
+            return "unknown", ""
+        data = await resp.json()
+        return (data.get("language") or "unknown"), (data.get("text") or "")
 
-async def whisper_translate(pcm: bytes) -> str:
-    wav = pcm_to_wav(pcm)
-    url = "https://api.openai.com/v1/audio/translations"
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
 
-    form = aiohttp.FormData()
-    form.add_field("file", wav, filename="audio.wav", content_type="audio/wav")
-    form.add_field("model", "whisper-1")
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=form) as resp:
-            if resp.status != 200:
-                log.error(await resp.text())
-                return ""
-            data = await resp.json()
-            return data.get("text", "")
+async def whisper_translate(pcm: PCMLike) -> str:
+    url = "https://api.openai.com/v1/audio/translations"
+    if WHISPER_TRANSLATE_8K:
+        pcm = downsample_to_8k(pcm)
+        hdr = wav_header(len(pcm), sample_rate=8000)
+    else:
+        hdr = wav_header(len(pcm))
+    body, content_type = build_whisper_multipart((hdr, pcm))
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": content_type}
+
+    session = get_session()
+    async with session.post(url, headers=headers, data=body) as resp:
+        if resp.status != 200:
+            log.error(await resp.text())
+            return ""
+        data = await resp.json()
+        return data.get("text", "")
 
 
 # =============================
@@ -129,16 +246,56 @@ async def ws_multilang_adaptive(ws: WebSocket):
     await ws.accept()
     log.info("🔌 Multi-lang adaptive connected")
 
-    # -------- buffers --------
-    current_utt_audio = bytearray()
-    last_voice_time: Optional[float] = None
+    # -------- client id → 上次的語言 hint --------
+    # 有 client_id → 從檔案載回上次的候選語言，之後也只存回這份；沒有就從空的開始
+    query = parse_qs(ws.url.query)
+    client_id = query.get("client_id", [""])[0]
+    candidates: List[str] = []
+    if client_id:
+        candidates = await asyncio.to_thread(load_lang_hints, client_id)
+
+    save_task: Optional[asyncio.Task] = None
+
+    def schedule_save_hints():
+        # debounce：5 秒內多句只寫一次檔
+        nonlocal save_task
+        if not client_id or (save_task and not save_task.done()):
+            return
+
+        async def delayed_save():
+            await asyncio.sleep(LANG_HINT_SAVE_SEC)
+            await asyncio.to_thread(save_lang_hints, client_id, list(candidates))
 
-    # silence params (same class as auto mode)
-    SILENCE_RMS = 300
-    SILENCE_SEC = 0.8
+        save_task = asyncio.create_task(delayed_save())
+
+    # -------- buffers --------
+    # 這句的 PCM 直接寫進 pool 借來的 slab（write_pos 之前是有效資料）
+    # utt_start = utt_buf[0] 在整條 stream 裡的 byte 位置（對得上 Azure 的 offset）
+    pcm_pool = PCMBufferPool(MAX_UTT_BYTES, PCM_POOL_SIZE)
+    utt_buf = pcm_pool.acquire()
+    write_pos = 0
+    utt_start = 0
+
+    # 還沒寫進 Azure push stream 的 frames（湊滿 PUSH_COALESCE_BYTES 才寫）
+    push_chunks: List[bytes] = []
+    push_len = 0
+    pushed_bytes = 0
+
+    # Azure 還活著就用它斷句；被 cancel 之後改用 RMS（silence_bytes 算靜音長度）
+    azure_ok = True
+    voiced = False
+    silence_bytes = 0
+
+    # 這條連線的背景 task（utterance / partial send）：留 reference 免得被 GC，斷線時一起 cancel
+    bg_tasks: Set[asyncio.Task] = set()
+    # 斷線開始清理後設成 True：recognizer 停下來前 SDK 還可能送 recognized 進來，
+    # 那時 utt_buf 已經要還回 pool 了 → 不能再碰
+    closed = False
+    # 只擋這條連線自己的 Whisper call（別的使用者不受影響）
+    utt_sem = asyncio.Semaphore(UTT_CONCURRENCY)
 
     # =============================
-    # Azure ASR (partial only)
+    # Azure ASR (partial + endpointing)
     # =============================
     speech_config = speechsdk.SpeechConfig(
         subscription=AZURE_SPEECH_KEY,
@@ -146,12 +303,7 @@ async def ws_multilang_adaptive(ws: WebSocket):
     )
 
     auto_lang_config = speechsdk.languageconfig.AutoDetectSourceLanguageConfig(
-        languages=[
-            "en-US", "ja-JP", "zh-TW", "zh-CN",
-            "ko-KR", "es-ES", "fr-FR", "de-DE",
-            "pt-PT", "th-TH", "vi-VN", "id-ID",
-            "ms-MY", "hi-IN",
-        ]
+        languages=list(dict.fromkeys(LANG_MAP.values())),
     )
 
     audio_format = speechsdk.audio.AudioStreamFormat(16000, 16, 1)
@@ -166,47 +318,144 @@ async def ws_multilang_adaptive(ws: WebSocket):
 
     loop = asyncio.get_running_loop()
 
-    async def send_partial(text: str):
-        await ws.send_json({"type": "partial", "text": text})
+    async def send(obj: dict):
+        # orjson 比 send_json 的 json.dumps 快很多；仍送 text frame
+        # （前端 binaryType=arraybuffer，binary frame 不能直接 JSON.parse）
+        await ws.send_text(orjson.dumps(obj).decode())
+
+    def spawn(coro):
+        if closed:
+            coro.close()
+            return
+        task = asyncio.create_task(coro)
+        bg_tasks.add(task)
+        task.add_done_callback(bg_tasks.discard)
+
+    # partial：SDK thread 丟進 SimpleQueue，只有 queue 從空變成有東西時才叫醒 loop 一次；
+    # flush_partials 把 queue 清空、只送最新的那一個（沒人講話就完全不會醒）
+    partial_q: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+    partial_scheduled = False
 
     def on_recognizing(evt):
-        if evt.result.text:
-            asyncio.run_coroutine_threadsafe(
-                send_partial(evt.result.text),
-                loop,
-            )
+        nonlocal partial_scheduled
+        if not evt.result.text:
+            return
+        partial_q.put_nowait(evt.result.text)
+        if not partial_scheduled:
+            partial_scheduled = True
+            loop.call_soon_threadsafe(flush_partials)
+
+    def flush_partials():
+        # 先清 flag 再 drain → drain 之後才進來的 partial 一定會再排一次 flush
+        nonlocal partial_scheduled
+        partial_scheduled = False
+        text = None
+        while True:
+            try:
+                text = partial_q.get_nowait()
+            except queue.Empty:
+                break
+        if text is not None:
+            spawn(send({"type": "partial", "text": text}))
+
+    def finalize_utterance(has_text: bool, end_byte: Optional[int] = None):
+        # 在 event loop 上跑：一句結束 → 把 [0, cut) 這段 PCM 交給 Whisper
+        # end_byte = Azure 說這段語音真正結束的位置；event 送到時 slab 後面
+        # 可能已經收了下一句的開頭 → 那部分留在新的 slab 裡，不要黏到這句
+        nonlocal utt_buf, write_pos, utt_start
+        if closed:
+            return
+        if end_byte is None:
+            cut = write_pos
+        else:
+            cut = min(max(min(end_byte, pushed_bytes) - utt_start, 0), write_pos) & ~1
+        if not cut:
+            return
+        rest = write_pos - cut
+        utt_start += cut
+        write_pos = rest
+        if not has_text:
+            # NoMatch（只有靜音 / 雜音）→ 只丟掉這段，不要送去 Whisper
+            utt_buf[:rest] = utt_buf[cut:cut + rest]
+            return
+        slab = utt_buf
+        utt_buf = pcm_pool.acquire()
+        utt_buf[:rest] = slab[cut:cut + rest]
+        spawn(run_utterance(slab, cut))
+
+    async def run_utterance(slab: bytearray, n: int):
+        # slab 在 handle_utterance 跑完之前不能被下一句覆寫 → 結束後才還回 pool
+        try:
+            with memoryview(slab)[:n] as pcm:
+                await handle_utterance(pcm)
+        finally:
+            pcm_pool.release(slab)
+
+    def on_recognized(evt):
+        # 斷句交給 Azure 自己的 VAD（SDK thread → 丟回 loop）
+        result = evt.result
+        end_byte = None
+        if result.duration:
+            end_byte = (result.offset + result.duration) * PCM_BYTES_PER_SEC // TICKS_PER_SEC
+        loop.call_soon_threadsafe(finalize_utterance, bool(result.text), end_byte)
+
+    def azure_canceled(reason, error: str):
+        nonlocal azure_ok
+        if not azure_ok or reason == speechsdk.CancellationReason.EndOfStream:
+            return
+        azure_ok = False
+        log.error(f"❌ Azure ASR canceled ({reason}): {error} → fallback to RMS VAD")
+
+    def on_canceled(evt):
+        details = evt.cancellation_details
+        loop.call_soon_threadsafe(azure_canceled, details.reason, details.error_details)
 
     recognizer.recognizing.connect(on_recognizing)
-    recognizer.start_continuous_recognition_async().get()
-    log.info("🟢 Azure ASR started (partial only)")
+    recognizer.recognized.connect(on_recognized)
+    recognizer.canceled.connect(on_canceled)
+    # SDK 的 .get() 會 block → 丟到 thread pool 等，不要卡住其他連線的 event loop
+    await loop.run_in_executor(
+        None, lambda: recognizer.start_continuous_recognition_async().get()
+    )
+    log.info("🟢 Azure ASR started (partial + endpointing)")
 
     # =============================
     # Utterance handler
     # =============================
-    async def handle_utterance(pcm: bytes):
+    async def handle_utterance(pcm: PCMLike):
         # ✅ Fast-path: use cached language
-        lang_hint = get_lang_hint()
-        lang, text = await whisper_transcribe_with_hint(pcm, lang_hint)
+        #    transcribe / translate 互不相依 → 同時打，latency 變成兩者取 max
+        #    semaphore 只包 Whisper call，送 WebSocket 前就放掉
+        lang_hint = get_lang_hint(candidates)
+        async with utt_sem:
+            (lang, text), translated = await asyncio.gather(
+                whisper_transcribe_with_hint(pcm, lang_hint),
+                whisper_translate(pcm),
+            )
 
-        # 🛡 fallback: hint decode failed
-        if not text.strip():
-            lang, text = await whisper_transcribe_with_hint(pcm, None)
+            # 🛡 fallback: hint decode failed
+            has_text = bool(text.strip())
+            if not has_text:
+                lang, text = await whisper_transcribe_with_hint(pcm, None)
+                has_text = bool(text.strip())
 
         log.info(f"🧠 Whisper result: lang={lang}, text={text}")
-        update_candidates(lang)
+        has_translated = bool(translated.strip())
+
+        update_candidates(lang, candidates)
+        schedule_save_hints()
 
-        if text.strip():
-            await ws.send_json({
+        if has_text:
+            await send({
                 "type": "final",
                 "text": text,
                 "lang": lang,
             })
 
-        translated = await whisper_translate(pcm)
         log.info(f"🌍 Whisper translated: {translated}")
 
-        if translated.strip():
-            await ws.send_json({
+        if has_translated:
+            await send({
                 "type": "final_translate",
                 "translated": translated,
                 "provisional": False,
@@ -219,30 +468,51 @@ async def ws_multilang_adaptive(ws: WebSocket):
     # =============================
     try:
         async for chunk in ws.iter_bytes():
-            current_utt_audio.extend(chunk)
-            push_stream.write(chunk)
-
-            energy = rms_energy(chunk)
-            now = time.perf_counter()
-
-            if energy > SILENCE_RMS:
-                last_voice_time = now
+            n = len(chunk)
+            if write_pos + n > len(utt_buf):
+                # 一句長到 slab 塞不下 → 先把目前這段當一句送出
+                finalize_utterance(True)
+            utt_buf[write_pos:write_pos + n] = chunk
+            write_pos += n
+
+            if azure_ok:
+                # 小 frame 先攢到 ~100ms 再一次寫進 Azure push stream
+                push_chunks.append(chunk)
+                push_len += n
+                if push_len >= PUSH_COALESCE_BYTES:
+                    push_stream.write(b"".join(push_chunks))
+                    pushed_bytes += push_len
+                    push_chunks.clear()
+                    push_len = 0
+                continue
+
+            # 🛡 Azure 掛了 → 本地 RMS VAD（講過話之後靜音 SILENCE_SEC 就斷句）
+            if rms_energy(chunk) > SILENCE_RMS:
+                voiced = True
+                silence_bytes = 0
             else:
-                if (
-                    last_voice_time
-                    and now - last_voice_time > SILENCE_SEC
-                    and current_utt_audio
-                ):
-                    utt_pcm = bytes(current_utt_audio)
-                    current_utt_audio.clear()
-                    last_voice_time = None
-
-                    asyncio.create_task(handle_utterance(utt_pcm))
+                silence_bytes += n
+                if voiced and silence_bytes > SILENCE_BYTES:
+                    finalize_utterance(True)
+                    voiced = False
+                    silence_bytes = 0
 
     finally:
         log.info("🔌 Multi-lang adaptive disconnected")
+        closed = True
+        # cancel 之後 run_utterance 的 finally 會把 slab 還回 pool
+        for task in list(bg_tasks):
+            task.cancel()
+        # 先把 recognizer 停掉（停的時候還會 flush 最後一個 recognized），才能還 utt_buf
         try:
-            recognizer.stop_continuous_recognition_async().get()
+            await loop.run_in_executor(
+                None, lambda: recognizer.stop_continuous_recognition_async().get()
+            )
             push_stream.close()
         except Exception:
             pass
+        pcm_pool.release(utt_buf)
+        if save_task and not save_task.done():
+            # 斷線前還沒寫的 hint 直接寫掉
+            save_task.cancel()
+            await asyncio.to_thread(save_lang_hints, client_id, list(candidates))
@@ -20,6 +20,20 @@ function floatToPCM16(input: Float32Array): ArrayBuffer {
   return buffer;
 }
 
+/* Stable per-browser id (backend keeps language hints per client) */
+function getClientId(): string {
+  const KEY = "asr_client_id";
+  let id = localStorage.getItem(KEY);
+  if (!id) {
+    id =
+      typeof crypto !== "undefined" && "randomUUID" in crypto
+        ? crypto.randomUUID()
+        : Math.random().toString(36).slice(2) + Date.now().toString(36);
+    localStorage.setItem(KEY, id);
+  }
+  return id;
+}
+
 /* =============================
    Types
 ============================= */
@@ -80,13 +94,11 @@ const [fixedLang, setFixedLang] = useState<string>("zh-TW"); // default Chinese
     let wsUrl ="wss://instant-translation-backend-c4fpb7arc0f8d5cv.eastus-01.azurewebsites.net/ws";
    
    if (mode === "auto") {
-     wsUrl =
-       "wss://instant-translation-backend-c4fpb7arc0f8d5cv.eastus-01.azurewebsites.net/ws";
+     wsUrl = `wss://instant-translation-backend-c4fpb7arc0f8d5cv.eastus-01.azurewebsites.net/ws?client_id=${getClientId()}`;
    } else if (mode === "fixed") {
      wsUrl = `wss://instant-translation-backend-c4fpb7arc0f8d5cv.eastus-01.azurewebsites.net/ws/fixed?lang=${fixedLang}`;
    } else if (mode === "multilang") {
-     wsUrl =
-       "wss://instant-translation-backend-c4fpb7arc0f8d5cv.eastus-01.azurewebsites.net/ws/multilang";
+     wsUrl = `wss://instant-translation-backend-c4fpb7arc0f8d5cv.eastus-01.azurewebsites.net/ws/multilang?client_id=${getClientId()}`;
    }
 
     ws = new WebSocket(wsUrl);